@@ -18,13 +18,54 @@ from processor.engine import train_one_epoch, evaluate
 from processor.optim_factory import create_optimizer, LayerDecayValueAssigner
 from util.utils import NativeScalerWithGradNormCount as NativeScaler
 from util import utils
-from util.utils import create_logger, SoftCrossEntropyLoss
+from util.utils import create_logger, SoftCrossEntropyLoss, CUDAPrefetcher, IndexSampler, seed_worker
 import torch.distributed as dist
 import warnings
 
 warnings.filterwarnings('ignore')
 
 
+def build_val_loader(args, device):
+    # built on first use so runs that never validate skip the directory scan and the worker fork
+    dataset_val, _ = build_dataset(is_train=False, args=args)
+    # the val loader queues fewer batches since they are 1.5x larger, keeping the pinned memory bounded
+    loader_kwargs = {}
+    if args.num_workers > 0:
+        loader_kwargs = dict(persistent_workers=True, prefetch_factor=max(1, int(args.prefetch_factor / 1.5)))
+    # in-order pass over the full set; the indices are swapped per epoch by sample_val_subset
+    sampler = IndexSampler(range(len(dataset_val)))
+    g = torch.Generator()
+    g.manual_seed(args.seed)
+    data_loader_val = DataLoader(dataset_val, sampler=sampler, batch_size=int(1.5 * args.batch_size), shuffle=False,
+                                 num_workers=args.num_workers, pin_memory=args.pin_mem, drop_last=False,
+                                 worker_init_fn=seed_worker, generator=g, **loader_kwargs)
+    data_loader_val = CUDAPrefetcher(data_loader_val, device, memory_format=torch.channels_last)
+    return dataset_val, data_loader_val
+
+
+def sample_val_subset(data_loader_val, ratio, seed):
+    # restrict the next validation pass to a random fraction of the val set, ratio >= 1 means the full set;
+    # the sampler lives in the main process, so this also works with persistent workers
+    loader = data_loader_val.loader
+    n_val = len(loader.dataset)
+    if ratio >= 1.:
+        loader.sampler.indices = range(n_val)
+    else:
+        # drawn from a dedicated generator so the eval cadence leaves the global RNG stream untouched
+        n_subset = min(n_val, max(int(n_val * ratio), 1))
+        g = torch.Generator()
+        g.manual_seed(seed)
+        loader.sampler.indices = sorted(torch.randperm(n_val, generator=g)[:n_subset].tolist())
+    return len(loader.sampler.indices)
+
+
+def eval_ratio(value):
+    ratio = float(value)
+    if not 0. < ratio <= 1.:
+        raise argparse.ArgumentTypeError('fast_eval_ratio must be in (0, 1], got %s' % value)
+    return ratio
+
+
 def main(args):
     # ---------------------- prepare running --------------------------------
     # GPU settings
@@ -32,25 +73,38 @@ def main(args):
     assert torch.cuda.is_available()
     os.environ['CUDA_VISIBLE_DEVICES'] = '0'
     device = torch.device("cuda")
+    torch.cuda.set_device(0)
+    torch.cuda.init()
+    # persist the TorchInductor FX graph cache so torch.compile is not redone on every run
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(os.path.dirname(args.output_dir), 'inductor_cache'))
     # logging file
-    if args.eval is False:
-        logger = create_logger(output_dir=args.output_dir)
-    else:
-        logger = None
+    logger = create_logger(output_dir=args.output_dir)
     # fix the seed for reproducibility
     seed = args.seed
     torch.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
     np.random.seed(seed)
     cudnn.benchmark = True
+    # TF32 Tensor Core math for FP32 matmuls/convs on Ampere and newer
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
 
     # ------------------------- build dataset ------------------------------
-    dataset_train, args.nb_classes = build_dataset(is_train=True, args=args)
+    if not args.eval:
+        dataset_train, args.nb_classes = build_dataset(is_train=True, args=args)
+        n_train = len(dataset_train)
+    else:
+        # eval only: skip the training tree scan, the classifier head of the checkpoint gives the class count
+        eval_ckpt = utils.load_checkpoint("checkpoint/" + args.dataset + ".pth", map_location=device)["model"]
+        if 'head.weight' in eval_ckpt:
+            args.nb_classes = eval_ckpt['head.weight'].shape[0]
     # Disabling evaluation during training
     if args.disable_eval:
         args.dist_eval = False
-        dataset_val = None
-    else:
-        dataset_val, _ = build_dataset(is_train=False, args=args)
+    # the validation set is built lazily by build_val_loader
+    dataset_val, data_loader_val = None, None
 
     if args.log_dir is not None:  # 没用
         os.makedirs(args.log_dir, exist_ok=True)
@@ -63,10 +117,19 @@ def main(args):
     else:
         wandb_logger = None
 
-    data_loader_train = DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True,
-                                   num_workers=args.num_workers, pin_memory=args.pin_mem, drop_last=True)
-    data_loader_val = DataLoader(dataset_val, batch_size=int(1.5 * args.batch_size), shuffle=False,
-                                 num_workers=args.num_workers, pin_memory=args.pin_mem, drop_last=True)
+    # asynchronous host-to-device copies in CUDAPrefetcher require page-locked batches
+    args.pin_mem = True
+    if not args.eval:
+        # keep workers alive across epochs
+        train_loader_kwargs = {}
+        if args.num_workers > 0:
+            train_loader_kwargs = dict(persistent_workers=True, prefetch_factor=args.prefetch_factor)
+        g = torch.Generator()
+        g.manual_seed(seed)
+        data_loader_train = DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True,
+                                       num_workers=args.num_workers, pin_memory=args.pin_mem, drop_last=True,
+                                       worker_init_fn=seed_worker, generator=g, **train_loader_kwargs)
+        data_loader_train = CUDAPrefetcher(data_loader_train, device, memory_format=torch.channels_last)
 
     # ------------------------- mixup setting ------------------------------
     # mixup_fn = None
@@ -90,24 +153,29 @@ def main(args):
             use_mha=args.use_mha,
             use_ref=args.use_ref,
         )
-        checkpoint = torch.load(args.finetune, map_location='cpu')
-        checkpoint_model = None
-        for model_key in args.model_key.split('|'):
-            if model_key in checkpoint:
-                checkpoint_model = checkpoint[model_key]
-                logger.info("Load state_dict by model_key = %s" % model_key)
-                break
-        if checkpoint_model is None:
-            checkpoint_model = checkpoint
-        state_dict = model.state_dict()
-        for k in ['head.weight', 'head.bias']:
-            if k in checkpoint_model and checkpoint_model[k].shape != state_dict[k].shape:
-                del checkpoint_model[k]
-        utils.load_state_dict(model, checkpoint_model, prefix=args.model_prefix)
+        # eval only: the eval checkpoint replaces these weights anyway
+        if not args.eval:
+            # the model is still on the CPU here, so the weights are mapped there
+            checkpoint = utils.load_checkpoint(args.finetune, map_location='cpu')
+            checkpoint_model = None
+            for model_key in args.model_key.split('|'):
+                if model_key in checkpoint:
+                    checkpoint_model = checkpoint[model_key]
+                    logger.info("Load state_dict by model_key = %s" % model_key)
+                    break
+            if checkpoint_model is None:
+                checkpoint_model = checkpoint
+            state_dict = model.state_dict()
+            for k in ['head.weight', 'head.bias']:
+                if k in checkpoint_model and checkpoint_model[k].shape != state_dict[k].shape:
+                    del checkpoint_model[k]
+            utils.load_state_dict(model, checkpoint_model, prefix=args.model_prefix)
     else:
         ValueError("Unsupported model: %s" % args.model)
 
     model.to(device)
+    # NHWC lets cuDNN (with cudnn.benchmark) pick the Tensor Core conv kernels, best paired with --use_amp
+    model = model.to(memory_format=torch.channels_last)
     model_ema = None
     # EMA滑动平均训练方式
     if args.model_ema:  # 没用
@@ -119,12 +187,36 @@ def main(args):
             resume='')
         logger.info("Using EMA with decay = %.8f" % args.model_ema_decay)
 
-    model_without_ddp = model
-    n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    # compile after EMA creation so that the EMA copy stays an eager module; default mode rather than
+    # "reduce-overhead": the model is called several times per step and its outputs are read afterwards,
+    # which CUDA graph replays would overwrite. A single eval pass does not pay back the compile time.
+    if hasattr(torch, 'compile') and not args.eval:
+        model = torch.compile(model, fullgraph=False, dynamic=False)
+    model_without_ddp = model._orig_mod if hasattr(model, "_orig_mod") else model
+
+    if args.amp_dtype is None:
+        args.amp_dtype = 'bf16' if torch.cuda.is_bf16_supported() else 'fp16'
+    amp_dtype = torch.bfloat16 if args.amp_dtype == 'bf16' else torch.float16
+
+    # for evaluation, Perform evaluation only
+    if args.eval:
+        logger.info(f"Eval only mode")
+        # drop unknown keys in place rather than building a second model-sized dict
+        keys = set(model_without_ddp.state_dict())
+        for k in list(eval_ckpt):
+            if k not in keys:
+                del eval_ckpt[k]
+        model_without_ddp.load_state_dict(eval_ckpt)
+        dataset_val, data_loader_val = build_val_loader(args, device)
+        n_val = len(dataset_val)
+        test_stats = evaluate(data_loader_val, model, device, use_amp=args.use_amp, logger=logger,
+                              update_freq=args.update_freq, amp_dtype=amp_dtype)
+        logger.info(f"Accuracy of the network on {n_val} test images: {test_stats['acc1']:.5f}%")
+        return
 
     # total_batch_size = args.batch_size * args.update_freq * utils.get_world_size()
     total_batch_size = args.batch_size * args.update_freq
-    num_training_steps_per_epoch = len(dataset_train) // total_batch_size
+    num_training_steps_per_epoch = n_train // total_batch_size
 
     if args.layer_decay < 1.0 or args.layer_decay > 1.0:
         num_layers = 12  # convnext layers divided into 12 parts, each with a different decayed lr value.
@@ -144,7 +236,8 @@ def main(args):
         get_num_layer=assigner.get_layer_id if assigner is not None else None,
         get_layer_scale=assigner.get_scale if assigner is not None else None)
 
-    loss_scaler = NativeScaler()  # if args.use_amp is False, this won't be used  False
+    # bf16 keeps the fp32 exponent range, so it runs without loss scaling
+    loss_scaler = NativeScaler(enabled=args.amp_dtype != 'bf16')  # if args.use_amp is False, this won't be used
     # schedule
     logger.info("Use Cosine LR scheduler")
     lr_schedule_values = utils.cosine_scheduler(
@@ -156,6 +249,9 @@ def main(args):
         args.weight_decay_end = args.weight_decay
     wd_schedule_values = utils.cosine_scheduler(
         args.weight_decay, args.weight_decay_end, args.epochs, num_training_steps_per_epoch)
+    # plain Python floats, so train_one_epoch does not convert a numpy scalar on every step
+    lr_schedule_values = lr_schedule_values.tolist()
+    wd_schedule_values = wd_schedule_values.tolist()
 
     if mixup_fn is not None:
         # smoothing is handled with mixup label transform
@@ -170,102 +266,111 @@ def main(args):
     utils.auto_load_model(
         args=args, model=model, model_without_ddp=model_without_ddp,
         optimizer=optimizer, loss_scaler=loss_scaler, model_ema=model_ema)
-    # for evaluation, Perform evaluation only
-    if args.eval:
-        logger.info(f"Eval only mode")
-        ckpt = torch.load("checkpoint/" + args.dataset + ".pth")["model"]
-        model_dict = model.state_dict()
-        ckpt = {k: v for k, v in ckpt.items() if k in model_dict}
-        model.load_state_dict(ckpt)
-        test_stats = evaluate(data_loader_val, model, device, use_amp=args.use_amp, logger=logger,
-                              update_freq=args.update_freq)
-        logger.info(f"Accuracy of the network on {len(dataset_val)} test images: {test_stats['acc1']:.5f}%")
-        return
 
     # ------------------------- training stage ------------------------------
+    # the optimizer groups already hold exactly the trainable parameters
+    n_parameters = sum(p.numel() for group in optimizer.param_groups for p in group['params'] if p.requires_grad)
     max_accuracy = 0.0
     if args.model_ema and args.model_ema_eval:
         max_accuracy_ema = 0.0
     logger.info("Start training")
     start_time = time.time()
-    for epoch in range(args.start_epoch, args.epochs):
-        if log_writer is not None:  # Tensorboard
-            log_writer.set_step(epoch * num_training_steps_per_epoch * args.update_freq)
-        if wandb_logger:  # wandb
-            wandb_logger.set_steps()
-        # training
-        train_stats = train_one_epoch(
-            model, criterion, data_loader_train, optimizer,
-            device, epoch, loss_scaler, args.clip_grad, model_ema, mixup_fn,
-            log_writer=log_writer, wandb_logger=wandb_logger, start_steps=epoch * num_training_steps_per_epoch,
-            lr_schedule_values=lr_schedule_values, wd_schedule_values=wd_schedule_values,
-            num_training_steps_per_epoch=num_training_steps_per_epoch, update_freq=args.update_freq,
-            use_amp=args.use_amp, logger=logger
-        )
-        # save params
-        if args.output_dir and args.save_ckpt:
-            if (epoch + 1) % args.save_ckpt_freq == 0 or epoch + 1 == args.epochs:
-                utils.save_model(
-                    args=args, model=model, model_without_ddp=model_without_ddp, optimizer=optimizer,
-                    loss_scaler=loss_scaler, epoch=epoch, model_ema=model_ema)
-
-        # evaluate
-        if data_loader_val is not None:
-            test_stats = evaluate(data_loader_val, model, device, use_amp=args.use_amp, logger=logger,
-                                  update_freq=args.update_freq)
-            logger.info(f"test accuracy : {test_stats['acc1']:.1f}%")
-            if max_accuracy < test_stats["acc1"]:
-                max_accuracy = test_stats["acc1"]
-                if wandb_logger is not None:
-                    wandb.run.summary["Best Accuracy"] = max_accuracy
-                    wandb.run.summary["Best Epoch"] = epoch
-                if args.output_dir and args.save_ckpt:
+    # opened once for the whole run, line buffered so every epoch is still on disk right away
+    record_f = None
+    if args.output_dir:
+        record_f = open(os.path.join(args.output_dir, "record.txt"), mode="a", encoding="utf-8", buffering=1)
+    try:
+        for epoch in range(args.start_epoch, args.epochs):
+            if log_writer is not None:  # Tensorboard
+                log_writer.set_step(epoch * num_training_steps_per_epoch * args.update_freq)
+            if wandb_logger:  # wandb
+                wandb_logger.set_steps()
+            # training
+            train_stats = train_one_epoch(
+                model, criterion, data_loader_train, optimizer,
+                device, epoch, loss_scaler, args.clip_grad, model_ema, mixup_fn,
+                log_writer=log_writer, wandb_logger=wandb_logger, start_steps=epoch * num_training_steps_per_epoch,
+                lr_schedule_values=lr_schedule_values, wd_schedule_values=wd_schedule_values,
+                num_training_steps_per_epoch=num_training_steps_per_epoch, update_freq=args.update_freq,
+                use_amp=args.use_amp, logger=logger,
+                # free the grads instead of writing zeros into them (default since torch 2.0)
+                zero_grad_set_to_none=True, amp_dtype=amp_dtype, log_every=args.log_every
+            )
+            # save params
+            if args.output_dir and args.save_ckpt:
+                if (epoch + 1) % args.save_ckpt_freq == 0 or epoch + 1 == args.epochs:
                     utils.save_model(
                         args=args, model=model, model_without_ddp=model_without_ddp, optimizer=optimizer,
-                        loss_scaler=loss_scaler, epoch="best", model_ema=model_ema)
-            acc1 = test_stats["acc1"]
-            logger.info(f"Accuracy of the network on the {len(dataset_val)} test images: {acc1:.1f}%")
-            logger.info(f'Max accuracy: {max_accuracy:.2f}%')
-
-            if log_writer is not None:
-                log_writer.update(test_acc1=test_stats['acc1'], head="perf", step=epoch)
-                log_writer.update(test_acc5=test_stats['acc5'], head="perf", step=epoch)
-                log_writer.update(test_loss=test_stats['loss'], head="perf", step=epoch)
-
-            log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
-                         **{f'test_{k}': v for k, v in test_stats.items()},
-                         'epoch': epoch,
-                         'n_parameters': n_parameters}
-
-            # repeat testing routines for EMA, if ema eval is turned on
-            if args.model_ema and args.model_ema_eval:
-                test_stats_ema = evaluate(data_loader_val, model_ema.ema, device, use_amp=args.use_amp, logger=logger,
-                                          update_freq=args.update_freq)
-                # logger.info(f"Accuracy of the model EMA on {len(dataset_val)} test images: {test_stats_ema[
-                # 'acc1']:.1f}%")
-                if max_accuracy_ema < test_stats_ema["acc1"]:
-                    max_accuracy_ema = test_stats_ema["acc1"]
+                        loss_scaler=loss_scaler, epoch=epoch, model_ema=model_ema)
+
+            # evaluate
+            if not args.disable_eval:
+                if data_loader_val is None:
+                    dataset_val, data_loader_val = build_val_loader(args, device)
+                    n_val = len(dataset_val)
+                # a random subset per epoch for the curves, the full set on the checkpoint cadence
+                full_eval = (args.fast_eval_ratio >= 1. or (epoch + 1) % args.save_ckpt_freq == 0
+                             or epoch + 1 == args.epochs)
+                n_eval = sample_val_subset(data_loader_val, 1. if full_eval else args.fast_eval_ratio, seed + epoch)
+                test_stats = evaluate(data_loader_val, model, device, use_amp=args.use_amp, logger=logger,
+                                      update_freq=args.update_freq, amp_dtype=amp_dtype)
+                logger.info(f"test accuracy : {test_stats['acc1']:.1f}%")
+                # only full passes count towards the best accuracy, so it stays unbiased
+                if full_eval and max_accuracy < test_stats["acc1"]:
+                    max_accuracy = test_stats["acc1"]
+                    if wandb_logger is not None:
+                        wandb.run.summary["Best Accuracy"] = max_accuracy
+                        wandb.run.summary["Best Epoch"] = epoch
                     if args.output_dir and args.save_ckpt:
                         utils.save_model(
                             args=args, model=model, model_without_ddp=model_without_ddp, optimizer=optimizer,
-                            loss_scaler=loss_scaler, epoch="best-ema", model_ema=model_ema)
-                    logger.info(f'Max EMA accuracy: {max_accuracy_ema:.2f}%')
+                            loss_scaler=loss_scaler, epoch="best", model_ema=model_ema)
+                acc1 = test_stats["acc1"]
+                logger.info(f"Accuracy of the network on the {n_eval}/{n_val} test images: {acc1:.1f}%")
+                logger.info(f'Max accuracy: {max_accuracy:.2f}%')
+
                 if log_writer is not None:
-                    log_writer.update(test_acc1_ema=test_stats_ema['acc1'], head="perf", step=epoch)
-                log_stats.update({**{f'test_{k}_ema': v for k, v in test_stats_ema.items()}})
-        else:
-            log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
-                         'epoch': epoch,
-                         'n_parameters': n_parameters}
-        # update logger info
-        if args.output_dir:
-            if log_writer is not None:
-                log_writer.flush()
-            with open(os.path.join(args.output_dir, "record.txt"), mode="a", encoding="utf-8") as f:
-                f.write(json.dumps(log_stats) + "\n")
-
-        if wandb_logger:
-            wandb_logger.log_epoch_metrics(log_stats)
+                    log_writer.update(test_acc1=test_stats['acc1'], head="perf", step=epoch)
+                    log_writer.update(test_acc5=test_stats['acc5'], head="perf", step=epoch)
+                    log_writer.update(test_loss=test_stats['loss'], head="perf", step=epoch)
+
+                log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
+                             **{f'test_{k}': v for k, v in test_stats.items()},
+                             'epoch': epoch,
+                             'full_eval': full_eval,
+                             'n_parameters': n_parameters}
+
+                # repeat testing routines for EMA, if ema eval is turned on
+                if args.model_ema and args.model_ema_eval:
+                    test_stats_ema = evaluate(data_loader_val, model_ema.ema, device, use_amp=args.use_amp,
+                                              logger=logger, update_freq=args.update_freq, amp_dtype=amp_dtype)
+                    # logger.info(f"Accuracy of the model EMA on {n_val} test images: {test_stats_ema[
+                    # 'acc1']:.1f}%")
+                    if full_eval and max_accuracy_ema < test_stats_ema["acc1"]:
+                        max_accuracy_ema = test_stats_ema["acc1"]
+                        if args.output_dir and args.save_ckpt:
+                            utils.save_model(
+                                args=args, model=model, model_without_ddp=model_without_ddp, optimizer=optimizer,
+                                loss_scaler=loss_scaler, epoch="best-ema", model_ema=model_ema)
+                        logger.info(f'Max EMA accuracy: {max_accuracy_ema:.2f}%')
+                    if log_writer is not None:
+                        log_writer.update(test_acc1_ema=test_stats_ema['acc1'], head="perf", step=epoch)
+                    log_stats.update({**{f'test_{k}_ema': v for k, v in test_stats_ema.items()}})
+            else:
+                log_stats = {**{f'train_{k}': v for k, v in train_stats.items()},
+                             'epoch': epoch,
+                             'n_parameters': n_parameters}
+            # update logger info
+            if args.output_dir:
+                if log_writer is not None and ((epoch + 1) % args.save_ckpt_freq == 0 or epoch + 1 == args.epochs):
+                    log_writer.flush()
+                record_f.write(json.dumps(log_stats) + "\n")
+
+            if wandb_logger:
+                wandb_logger.log_epoch_metrics(log_stats)
+    finally:
+        if record_f is not None:
+            record_f.close()
 
     if wandb_logger and args.wandb_ckpt and args.save_ckpt and args.output_dir:
         wandb_logger.log_checkpoints()
@@ -279,6 +384,15 @@ def main(args):
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser('ConvNeXt training and evaluation script', parents=[get_args_parser()])
+    parser.add_argument('--prefetch_factor', default=4, type=int,
+                        help='batches loaded in advance by each worker (gains flatten out beyond 4)')
+    parser.add_argument('--amp_dtype', default=None, choices=['bf16', 'fp16'],
+                        help='autocast dtype with --use_amp; defaults to bf16 when the GPU supports it')
+    parser.add_argument('--log_every', default=10, type=int,
+                        help='training steps between loss read-backs/logs; a non-finite loss is detected '
+                             'up to log_every - 1 optimizer steps late')
+    parser.add_argument('--fast_eval_ratio', default=0.1, type=eval_ratio,
+                        help='fraction of the val set evaluated between full passes (every save_ckpt_freq epochs)')
     args = parser.parse_args()
 
     args.output_dir = os.path.join(args.output_dir, '%s_%s' % (args.dataset, args.tag))
@@ -286,11 +400,13 @@ if __name__ == '__main__':
     if args.output_dir:
         Path(args.output_dir).mkdir(parents=True, exist_ok=True)
 
+    argsDict = args.__dict__
     with open(os.path.join(args.output_dir, 'config.txt'), 'w') as f:
-        argsDict = args.__dict__
-        f.writelines('------------------ start ------------------' + '\n')
-        for eachArg, value in argsDict.items():
-            f.writelines(eachArg + ' : ' + str(value) + '\n')
-        f.writelines('------------------- end -------------------')
+        f.write('------------------ start ------------------' + '\n' +
+                ''.join(eachArg + ' : ' + str(value) + '\n' for eachArg, value in argsDict.items()) +
+                '------------------- end -------------------')
+    # structured copy of the same config for downstream parsing
+    with open(os.path.join(args.output_dir, 'config.json'), 'w') as f:
+        json.dump(argsDict, f, indent=2, default=str)
 
     main(args)
@@ -16,25 +16,28 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     model_ema: Optional[ModelEma] = None, mixup_fn: Optional[Mixup] = None, log_writer=None,
                     wandb_logger=None, start_steps=None, lr_schedule_values=None, wd_schedule_values=None,
                     num_training_steps_per_epoch=None, update_freq=None, use_amp=False, logger=None,
+                    zero_grad_set_to_none=True, amp_dtype=torch.float16, log_every=10,
                     ):
     model.train(True)
     metric_logger = MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', SmoothedValue(window_size=1, fmt='{value:.6f}'))
     metric_logger.add_meter('min_lr', SmoothedValue(window_size=1, fmt='{value:.6f}'))
     header = 'Epoch: [{}]'.format(epoch)
-    print_freq = 10
 
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=zero_grad_set_to_none)
 
     # counter
     num_steps = len(data_loader)
     batch_time = AverageMeter()
     loss_meter = AverageMeter()
+    loss_sum = torch.zeros((), device=device)
+    class_acc_sum = torch.zeros((), device=device)
+    n_accum = 0
 
     start = time.time()
     end = time.time()
 
-    for data_iter_step, (samples, targets) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+    for data_iter_step, (samples, targets) in enumerate(metric_logger.log_every(data_loader, log_every, header)):
         step = data_iter_step // update_freq
         if step >= num_training_steps_per_epoch:
             continue
@@ -54,7 +57,7 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
             samples, targets = mixup_fn(samples, targets)
 
         if use_amp:
-            with torch.cuda.amp.autocast():
+            with torch.cuda.amp.autocast(dtype=amp_dtype):
                 input_pred, attention_map = model(samples)
         else:  # full precision
             input_pred, attention_map = model(samples)
@@ -80,11 +83,11 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
             loss = criterion(input_pred, targets)
             output = input_pred
 
-        loss_value = loss.item()
-
-        if not math.isfinite(loss_value):  # this could trigger if using AMP
-            logger.info("Loss is {}, stopping training".format(loss_value))
-            assert math.isfinite(loss_value)
+        # accumulated on the GPU, read back only every `log_every` steps to avoid a sync per step
+        loss_sum += loss.detach()
+        if mixup_fn is None:
+            class_acc_sum += (output.max(-1)[-1] == targets).float().mean()
+        n_accum += 1
 
         if use_amp:
             # this attribute is added by timm on one optimizer (adahessian)
@@ -94,26 +97,18 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                                     parameters=model.parameters(), create_graph=is_second_order,
                                     update_grad=(data_iter_step + 1) % update_freq == 0)
             if (data_iter_step + 1) % update_freq == 0:
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=zero_grad_set_to_none)
                 if model_ema is not None:
-                    model_ema.update(model)
+                    model_ema.update(getattr(model, '_orig_mod', model))
         else:  # full precision
             loss /= update_freq
             loss.backward()
             if (data_iter_step + 1) % update_freq == 0:
                 optimizer.step()
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=zero_grad_set_to_none)
                 if model_ema is not None:
-                    model_ema.update(model)
-
-        torch.cuda.synchronize()
+                    model_ema.update(getattr(model, '_orig_mod', model))
 
-        if mixup_fn is None:
-            class_acc = (output.max(-1)[-1] == targets).float().mean()
-        else:
-            class_acc = None
-        metric_logger.update(loss=loss_value)
-        metric_logger.update(class_acc=class_acc)
         min_lr = 10.
         max_lr = 0.
         for group in optimizer.param_groups:
@@ -127,10 +122,29 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
             if group["weight_decay"] > 0:
                 weight_decay_value = group["weight_decay"]
         metric_logger.update(weight_decay=weight_decay_value)
-        if use_amp:
+
+        if (data_iter_step + 1) % log_every != 0 and data_iter_step + 1 != num_training_steps_per_epoch * update_freq:
+            continue
+
+        loss_value = (loss_sum / n_accum).item()
+
+        if not math.isfinite(loss_value):  # this could trigger if using AMP
+            logger.info("Loss is {}, stopping training".format(loss_value))
+            assert math.isfinite(loss_value)
+
+        if mixup_fn is None:
+            class_acc = (class_acc_sum / n_accum).item()
+        else:
+            class_acc = None
+        metric_logger.meters['loss'].update(loss_value, n=n_accum)
+        if class_acc is not None:
+            metric_logger.meters['class_acc'].update(class_acc, n=n_accum)
+        if use_amp and grad_norm is not None:
+            grad_norm = grad_norm.item()
             metric_logger.update(grad_norm=grad_norm)
 
         if log_writer is not None:
+            log_writer.set_step(start_steps * update_freq + data_iter_step)
             log_writer.update(loss=loss_value, head="loss")
             log_writer.update(class_acc=class_acc, head="loss")
             log_writer.update(lr=max_lr, head="opt")
@@ -138,7 +152,6 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
             log_writer.update(weight_decay=weight_decay_value, head="opt")
             if use_amp:
                 log_writer.update(grad_norm=grad_norm, head="opt")
-            log_writer.set_step()
 
         if wandb_logger:
             wandb_logger._wandb.log({
@@ -152,20 +165,22 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                 wandb_logger._wandb.log({'Rank-0 Batch Wise/train_grad_norm': grad_norm}, commit=False)
             wandb_logger._wandb.log({'Rank-0 Batch Wise/global_train_step': it})
 
-        loss_meter.update(loss.item(), targets.size(0))
-        batch_time.update(time.time() - end)
+        loss_meter.update(loss_value, n_accum * targets.size(0))
+        batch_time.update((time.time() - end) / n_accum, n_accum)
         end = time.time()
-
-        if data_iter_step % update_freq == 0:
-            lr = max_lr
-            memory_used = torch.cuda.max_memory_allocated() / (1024.0 * 1024.0)
-            etas = batch_time.avg * (num_steps - data_iter_step)
-            logger.info(
-                f'Train: [{epoch}][{data_iter_step}/{num_steps}]\t'
-                f'eta {datetime.timedelta(seconds=int(etas))} lr {lr:.6f}\t'
-                f'time {batch_time.val:.4f} ({batch_time.avg:.4f})\t'
-                f'loss {loss_meter.val:.4f} ({loss_meter.avg:.4f})\t'
-                f'mem {memory_used:.0f}MB')
+        loss_sum.zero_()
+        class_acc_sum.zero_()
+        n_accum = 0
+
+        lr = max_lr
+        memory_used = torch.cuda.max_memory_allocated() / (1024.0 * 1024.0)
+        etas = batch_time.avg * (num_steps - data_iter_step)
+        logger.info(
+            f'Train: [{epoch}][{data_iter_step}/{num_steps}]\t'
+            f'eta {datetime.timedelta(seconds=int(etas))} lr {lr:.6f}\t'
+            f'time {batch_time.val:.4f} ({batch_time.avg:.4f})\t'
+            f'loss {loss_meter.val:.4f} ({loss_meter.avg:.4f})\t'
+            f'mem {memory_used:.0f}MB')
 
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
@@ -177,8 +192,8 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
     return train_stat
 
 
-@torch.no_grad()
-def evaluate(data_loader, model, device, use_amp=False, logger=None, update_freq=1):
+@torch.inference_mode()
+def evaluate(data_loader, model, device, use_amp=False, logger=None, update_freq=1, amp_dtype=torch.float16):
     criterion = torch.nn.CrossEntropyLoss()
 
     metric_logger = MetricLogger(delimiter="  ")
@@ -199,11 +214,11 @@ def evaluate(data_loader, model, device, use_amp=False, logger=None, update_freq
 
     end = time.time()
     idx = 0
-    with torch.no_grad():
+    with torch.inference_mode():
         for batch in metric_logger.log_every(data_loader, 10, header):
             images = batch[0]
             target = batch[-1]
-            label_true = target.numpy().squeeze()
+            label_true = target.cpu().numpy().reshape(-1)
             record_truth = np.concatenate((record_truth, label_true))
 
             images = images.to(device, non_blocking=True)
@@ -211,7 +226,7 @@ def evaluate(data_loader, model, device, use_amp=False, logger=None, update_freq
 
             # compute output
             if use_amp:
-                with torch.cuda.amp.autocast():
+                with torch.cuda.amp.autocast(dtype=amp_dtype):
                     input_pred, attention_map = model(images)
             else:
                 input_pred, attention_map = model(images)
@@ -229,7 +244,7 @@ def evaluate(data_loader, model, device, use_amp=False, logger=None, update_freq
 
             # record
             _, pred = torch.max(output, dim=1)
-            pred = pred.cpu().numpy().squeeze()
+            pred = pred.cpu().numpy().reshape(-1)
             record_pred = np.concatenate((record_pred, pred))
 
             acc1 = reduce_tensor(acc1)
@@ -141,7 +141,11 @@ def create_optimizer(args, model, get_num_layer=None, get_layer_scale=None, filt
     elif opt_lower == 'adam':
         optimizer = optim.Adam(parameters, **opt_args)
     elif opt_lower == 'adamw':
-        optimizer = optim.AdamW(parameters, **opt_args)
+        try:
+            # one fused CUDA kernel for all parameter updates (torch >= 2.0)
+            optimizer = optim.AdamW(parameters, fused=torch.cuda.is_available(), **opt_args)
+        except TypeError:
+            optimizer = optim.AdamW(parameters, **opt_args)
     elif opt_lower == 'nadam':
         optimizer = Nadam(parameters, **opt_args)
     elif opt_lower == 'radam':
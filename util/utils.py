@@ -14,6 +14,8 @@ import torch.nn as nn
 from tensorboardX import SummaryWriter
 from termcolor import colored
 import functools
+import pickle
+import zipfile
 import logging
 import sys
 import random
@@ -282,6 +284,65 @@ class WandbLogger(object):
         self._wandb.define_metric('Global Test/*', step_metric='epoch')
 
 
+class IndexSampler(torch.utils.data.Sampler):
+    """Yield the given dataset indices in order; ``indices`` may be replaced between epochs."""
+
+    def __init__(self, indices):
+        self.indices = indices
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class CUDAPrefetcher(object):
+    """Wrap a DataLoader and copy the next batch to the GPU on a side stream
+    while the current batch is being consumed by the model.
+    """
+
+    def __init__(self, loader, device, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream(device=device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            for t in batch:
+                # the tensors were allocated on the side stream, keep the allocator from reusing them too early
+                t.record_stream(current_stream)
+            next_batch = self._preload(loader_iter)
+            yield batch
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            batch = [t.to(self.device, non_blocking=True) for t in batch]
+            # only the images follow the model layout, labels are left untouched
+            batch[0] = batch[0].contiguous(memory_format=self.memory_format)
+            return batch
+
+
+def seed_worker(worker_id):
+    # numpy and random follow the per-worker torch seed, which the loader derives from its generator
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
 def setup_for_distributed(is_master):
     """
     This function disables printing when not in master process
@@ -360,6 +421,18 @@ def init_distributed_mode(args):
     setup_for_distributed(args.rank == 0)
 
 
+def load_checkpoint(path, map_location='cpu'):
+    # memory-map the file (zip format only) and skip the full unpickler when the checkpoint only holds tensors
+    try:
+        return torch.load(path, map_location=map_location, mmap=zipfile.is_zipfile(path), weights_only=True)
+    except TypeError:
+        # torch without mmap / weights_only support
+        return torch.load(path, map_location=map_location)
+    except pickle.UnpicklingError:
+        # custom pickled objects such as the args stored by save_model; weights_only defaults to True on torch >= 2.6
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+
 def load_state_dict(model, state_dict, prefix='', ignore_missing="relative_position_index"):
     missing_keys = []
     unexpected_keys = []
@@ -412,8 +485,9 @@ def load_state_dict(model, state_dict, prefix='', ignore_missing="relative_posit
 class NativeScalerWithGradNormCount:
     state_dict_key = "amp_scaler"
 
-    def __init__(self):
-        self._scaler = torch.cuda.amp.GradScaler()
+    def __init__(self, enabled=True):
+        # a disabled GradScaler turns scale/unscale/update into no-ops, e.g. for bf16 autocast
+        self._scaler = torch.cuda.amp.GradScaler(enabled=enabled)
 
     def __call__(self, loss, optimizer, clip_grad=None, parameters=None, create_graph=False, update_grad=True):
         self._scaler.scale(loss).backward(create_graph=create_graph)
@@ -532,7 +606,7 @@ def auto_load_model(args, model, model_without_ddp, optimizer, loss_scaler, mode
                     model_ema.ema.load_state_dict(checkpoint['model_ema'])
                 else:
                     model_ema.ema.load_state_dict(checkpoint['model'])
-            if 'scaler' in checkpoint:
+            if checkpoint.get('scaler'):  # empty when saved with the scaler disabled (bf16)
                 loss_scaler.load_state_dict(checkpoint['scaler'])
             print("With optim & sched!")
 